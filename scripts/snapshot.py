@@ -1,37 +1,47 @@
 import json
 import os
+import pickle
+import sys
 from collections import Counter, defaultdict
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from fractions import Fraction
 from functools import partial, wraps
-from itertools import zip_longest
+from multiprocessing import get_context
 from pathlib import Path
 
 import toml
+from Crypto.Hash import keccak as _keccak
 from brownie import Wei, accounts, rpc, web3
 from eth_abi import decode_single, encode_single
-from eth_abi.packed import encode_abi_packed
-from eth_utils import encode_hex
+from eth_utils import encode_hex, is_address, to_canonical_address
 from toolz import valfilter, valmap
 from tqdm import tqdm, trange
 from click import secho
 
+# layers narrower than this are hashed in-process, forking costs more than it saves
+PARALLEL_LAYER_THRESHOLD = 4096
+# every tree node is a keccak256 digest, layers are stored packed back to back
+NODE_SIZE = 32
+
 
 def cached(path):
     path = Path(path)
-    codec = {'.toml': toml, '.json': json}[path.suffix]
+    codec = {'.toml': toml, '.json': json, '.pickle': pickle}[path.suffix]
     codec_args = {'.json': {'indent': 2}}.get(path.suffix, {})
+    binary = path.suffix == '.pickle'
+    read = path.read_bytes if binary else path.read_text
+    write = path.write_bytes if binary else path.write_text
 
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
             if path.exists():
                 print('load from cache', path)
-                return codec.loads(path.read_text())
+                return codec.loads(read())
             else:
                 result = func(*args, **kwargs)
                 os.makedirs(path.parent, exist_ok=True)
-                path.write_text(codec.dumps(result, **codec_args))
+                write(codec.dumps(result, **codec_args))
                 print('write to cache', path)
                 return result
 
@@ -55,47 +65,107 @@ def cached(path):
 #     return valfilter(bool, dict(balances.most_common()))
 
 
+def k256(data):
+    h = _keccak.new(digest_bits=256)
+    h.update(data)
+    return h.digest()
+
+
+def pack_leaf(index, account, amount):
+    # abi.encodePacked(uint256, address, uint256)
+    # is_address rejects wrong lengths and bad EIP-55 checksums, as encode_abi_packed did
+    if not is_address(account):
+        raise ValueError(f'invalid address {account}')
+    return index.to_bytes(32, 'big') + to_canonical_address(account) + amount.to_bytes(32, 'big')
+
+
+def combined_hash(a, b):
+    return k256(a + b if a < b else b + a)
+
+
+def available_cpus():
+    # cores this process may run on, which can be fewer than the host has
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def hash_pair_chunk(chunk):
+    # chunk is a run of packed nodes starting on a pair boundary
+    out = bytearray(NODE_SIZE * ((len(chunk) // NODE_SIZE + 1) // 2))
+    view = memoryview(out)
+    paired = len(chunk) - len(chunk) % (2 * NODE_SIZE)
+    for i in range(0, paired, 2 * NODE_SIZE):
+        view[i // 2:i // 2 + NODE_SIZE] = combined_hash(chunk[i:i + NODE_SIZE], chunk[i + NODE_SIZE:i + 2 * NODE_SIZE])
+    # an odd node out is carried up unchanged
+    if paired < len(chunk):
+        view[paired // 2:] = chunk[paired:]
+    return out
+
+
 class MerkleTree:
     def __init__(self, elements):
-        self.elements = sorted(set(web3.keccak(hexstr=el) for el in elements))
-        self.layers = MerkleTree.get_layers(self.elements)
+        leaves = [(k256(el), i) for i, el in enumerate(elements)]
+        leaves.sort()
+        self.elements = []
+        # sorted leaf index of each input element, so callers never hash a leaf twice
+        self.positions = [0] * len(leaves)
+        for leaf, i in leaves:
+            if not self.elements or leaf != self.elements[-1]:
+                self.elements.append(leaf)
+            self.positions[i] = len(self.elements) - 1
+        self.layers = MerkleTree.get_layers(bytearray(b''.join(self.elements)))
 
     @property
     def root(self):
-        return self.layers[-1][0]
-
-    def get_proof(self, el):
-        el = web3.keccak(hexstr=el)
-        idx = self.elements.index(el)
-        proof = []
-        for layer in self.layers:
-            pair_idx = idx + 1 if idx % 2 == 0 else idx - 1
-            if pair_idx < len(layer):
-                proof.append(encode_hex(layer[pair_idx]))
-            idx //= 2
-        return proof
+        if not self.elements:
+            raise ValueError('merkle tree has no leaves')
+        return bytes(self.layers[-1][:NODE_SIZE])
+
+    def all_proofs(self):
+        # node i of layer d covers leaves [i << d, (i + 1) << d), each of them gets i's pair
+        n = len(self.elements)
+        proofs = [[] for _ in range(n)]
+        for depth, layer in enumerate(self.layers[:-1]):
+            packed = layer.hex()
+            hexes = ['0x' + packed[i:i + 2 * NODE_SIZE] for i in range(0, len(packed), 2 * NODE_SIZE)]
+            for i in range(len(hexes)):
+                pair_idx = i ^ 1
+                if pair_idx < len(hexes):
+                    sibling = hexes[pair_idx]
+                    for leaf in range(i << depth, min((i + 1) << depth, n)):
+                        proofs[leaf].append(sibling)
+        return proofs
 
     @staticmethod
     def get_layers(elements):
         layers = [elements]
-        while len(layers[-1]) > 1:
-            layers.append(MerkleTree.get_next_layer(layers[-1]))
+        workers = available_cpus()
+        # spawned workers would re-import and re-run this script, and fork is only safe on linux
+        serial = (len(elements) <= PARALLEL_LAYER_THRESHOLD * NODE_SIZE or workers == 1
+                  or not sys.platform.startswith('linux'))
+        if serial:
+            while len(layers[-1]) > NODE_SIZE:
+                layers.append(MerkleTree.get_next_layer(layers[-1]))
+            return layers
+        with ProcessPoolExecutor(workers, mp_context=get_context('fork')) as pool:
+            while len(layers[-1]) > NODE_SIZE:
+                layers.append(MerkleTree.get_next_layer(layers[-1], pool, workers))
         return layers
 
     @staticmethod
-    def get_next_layer(elements):
-        return [MerkleTree.combined_hash(a, b) for a, b in zip_longest(elements[::2], elements[1::2])]
-
-    @staticmethod
-    def combined_hash(a, b):
-        if a is None:
-            return b
-        if b is None:
-            return a
-        return web3.keccak(b''.join(sorted([a, b])))
+    def get_next_layer(elements, pool=None, workers=1):
+        elements = bytes(elements)
+        if pool is None or len(elements) <= PARALLEL_LAYER_THRESHOLD * NODE_SIZE:
+            return hash_pair_chunk(elements)
+        pairs = -(-len(elements) // (2 * NODE_SIZE))
+        size = 2 * NODE_SIZE * -(-pairs // workers)
+        shards = [elements[i:i + size] for i in range(0, len(elements), size)]
+        return bytearray(b''.join(pool.map(hash_pair_chunk, shards)))
 
 
-@cached('snapshot/01-balances.toml')
+@cached('snapshot/01-balances.pickle')
 def step_01():
     # print('step 01. snapshot token balances.')
     # balances = defaultdict(Counter)  # token -> user -> balance
@@ -122,15 +192,15 @@ def step_01():
 def step_07(balances):
     elements = [(index, account, amount)
                 for index, (account, amount) in enumerate(balances.items())]
-    nodes = [encode_hex(encode_abi_packed(
-        ['uint', 'address', 'uint'], el)) for el in elements]
+    nodes = [pack_leaf(*el) for el in elements]
     tree = MerkleTree(nodes)
+    proofs = tree.all_proofs()
     distribution = {
         'merkleRoot': encode_hex(tree.root),
         'tokenTotal': hex(sum(balances.values())),
         'claims': {
             user: {'index': index, 'amount': hex(
-                amount), 'proof': tree.get_proof(nodes[index])}
+                amount), 'proof': proofs[tree.positions[index]]}
             for index, user, amount in elements
         },
     }